@@ -7,6 +7,7 @@ import time
 import pandas as pd
 import geopandas as gpd
 import pyarrow.parquet as pq
+from cache import ArtifactCache, CACHE_DIR, iter_partitions, memoize, hash_file, code_version
 
 """
 example usage
@@ -29,6 +30,10 @@ DATAPATH = "./records"
 GEOMETRIES = "Africa_Boundaries-shp/Africa_Boundaries.dbf"
 RECORD_FILE = "./data/records_2020_2023.parquet"
 BATCH_SIZE = 4*10**5
+CACHE = ArtifactCache(CACHE_DIR)
+
+NEIGHBOURS_COLUMNS = ["ISO", "nISO", "Actor1CountryCode", "Actor2CountryCode",
+	"AvgTone", "GoldsteinScale", "Year", "Month", "Day"]
 
 
 def howmanybatches(record_file,btcsize):
@@ -126,26 +131,30 @@ def preprocess_batch_geometry(batch):
 def filter_by_year(record_file, year):
 	"""
 	Return the whole parque file filtering records belonging to the given year
+	and store it in './data/timeseries_year{year}.parquet'. The file is rebuilt
+	only when the records of that year changed; filtered partitions are not
+	cached, being as large as the records themselves.
  	Args: 
   		record_file: (str), filename
     		year:
 	"""
 	t0 = time.time()
 	print("Filtering by year:", year)
-	tosave = []
-	parquet_file = pq.ParquetFile(record_file)
-	for batch_partition in parquet_file.iter_batches(batch_size = BATCH_SIZE):
-		batch = batch_partition.to_pandas()
+	version = code_version(filter_by_year, preprocess_batch)
+
+	def compute(batch):
 		preprocess_batch(batch)
-		filtered = batch[batch.Year==year]
-		if filtered.shape[0] > 0:
-			tosave.append(filtered)
+		return batch[batch.Year==year]
+
+	def collapse(partitions):
+		return pd.concat([filtered for filtered in partitions if filtered.shape[0] > 0])
 
+	print("Now saving in './data'")
+	memoize(CACHE, f"./data/timeseries_year{year}.parquet",
+		lambda: iter_partitions(record_file, keep=lambda day: day[:4]==year, batch_size=BATCH_SIZE),
+		compute, collapse, "filter_by_year", year, version, store=False)
 	t1 = time.time()
 	print("Elapsed (sec):", round(t1-t0, 3))
-	print("Now saving in './data'")
-	tosave_df = pd.concat(tosave)
-	tosave_df.to_parquet(f"./data/timeseries_year{year}.parquet")	
 
 
 def filter_by_EOI(record_file, event):
@@ -213,37 +222,36 @@ def extracting_timeseries(record_file, country_names, cameos):
 		{str(item.day)   if len(str(item.day))==2 else '0'+str(item.day)}".replace("\t","")
 		for item in pd.date_range(pd.Timestamp('2020-01-01'), pd.Timestamp('2023-12-31'))]
 
-	tosave = []
-	for country in country_names:
-		batch = filter_by_country(record_file, country)
-		batch = batch[batch.EventRootCode.isin(cameos)]
-
-		tmp = pd.DataFrame({"Year":batch.Year,
-			"Month":batch.Month, 
-			"Day":batch.Day, 
-			"Date":batch.Year+batch.Month+batch.Day,
-			"EventRootCode":batch.EventRootCode})
-
-		gb = tmp.groupby(["Year", "Month", "Day", "Date"]).\
-			EventRootCode.count().reset_index()
-
-		current_dates = gb.Date.unique()
-
-		date_series = [gb[gb.Date==date].EventRootCode.values[0]\
-			if date in current_dates else 0 for date in dayslist]
+	version = code_version(extracting_timeseries, preprocess_batch)
 
-		tosave.append(pd.DataFrame({
-			"NAME_0":country,
-			"Date":dayslist,
-			"count":date_series
-			}))
+	def compute(batch):
+		# daily counts for every country in a single pass over the partition
+		preprocess_batch(batch)
+		batch = batch[batch.NAME_0.isin(country_names) & batch.EventRootCode.isin(cameos)]
+		tmp = pd.DataFrame({"NAME_0":batch.NAME_0,
+			"Date":batch.Year+batch.Month+batch.Day})
+		return tmp.groupby(["NAME_0", "Date"]).size().reset_index(name="count")
+
+	def collapse(partitions):
+		counts = pd.concat(partitions).\
+			groupby(["NAME_0", "Date"])["count"].sum()
+		tosave = []
+		for country in country_names:
+			date_series = [counts.get((country, date), 0) for date in dayslist]
+			tosave.append(pd.DataFrame({
+				"NAME_0":country,
+				"Date":dayslist,
+				"count":date_series
+				}))
+		return pd.concat(tosave)
 
+	print("Now saving in './data'")
+	memoize(CACHE, f"./data/timeseries_cameo{cameos[0]}.parquet",
+		lambda: iter_partitions(record_file, batch_size=BATCH_SIZE),
+		compute, collapse, "extracting_timeseries", country_names, cameos, version)
 	t1 = time.time()
 	print("Elapsed (sec):", round(t1-t0, 3))
-	print("Now saving in './data'")
-	tosave_df = pd.concat(tosave)
-	tosave_df.to_parquet(f"./data/timeseries_cameo{cameos[0]}.parquet")
-	return tosave_df
+	return pd.read_parquet(f"./data/timeseries_cameo{cameos[0]}.parquet")
 
 
 def get_neighbours(geom_filename):
@@ -275,8 +283,7 @@ def extract_relationships(record_file, geom_filename):
 
 	for year in ["2023"]:
 
-		if not os.path.exists(f"./data/timeseries_year{year}.parquet"):
-			filter_by_year(record_file, year)
+		filter_by_year(record_file, year)
 		parquet_file = pq.ParquetFile(f"./data/timeseries_year{year}.parquet")
 
 		for batch_partition in parquet_file.iter_batches(batch_size = BATCH_SIZE):
@@ -323,24 +330,27 @@ def extract_relationships(record_file, geom_filename):
 
 def extract_relationships_foreach_neighbours(record_file, geom_filename, year):
 	"""
-	Desctiption
+	Extract the average tone of the events happened in the neighbouring countries
+	of each state in the given year and store it in
+	'./data/neighbours_laginfo_{year}.parquet'. Only the partitions whose records,
+	boundaries or code changed are joined again.
 	"""
 	t0 = time.time()
 	print("Performing Neighbouring information extraction:")
-	tosave,tostore = dict(),[]
-	geometries = load_geometries(geom_filename)
-	neighbours = get_neighbours(geom_filename)
-
-	# initialize the structure
-	for country in neighbours:
-		tosave[country] = []
-
-	if not os.path.exists(f"./data/timeseries_year{year}.parquet"):
-		filter_by_year(record_file, year)
-	parquet_file = pq.ParquetFile(f"./data/timeseries_year{year}.parquet")
-	
-	for batch_partition in parquet_file.iter_batches(batch_size = BATCH_SIZE):
-		batch = batch_partition.to_pandas()
+	version = code_version(extract_relationships_foreach_neighbours,
+		preprocess_batch, preprocess_batch_geometry, load_geometries, get_neighbours)
+	boundaries = dict()
+
+	def load_boundaries():
+		# geometries and neighbours are needed only when a partition is recomputed
+		if boundaries == {}:
+			boundaries["geometries"] = load_geometries(geom_filename)
+			boundaries["neighbours"] = get_neighbours(geom_filename)
+		return boundaries["geometries"], boundaries["neighbours"]
+
+	def compute(batch):
+		tosave = []
+		geometries, neighbours = load_boundaries()
 		preprocess_batch(batch)
 		batch = preprocess_batch_geometry(batch)
 
@@ -364,17 +374,25 @@ def extract_relationships_foreach_neighbours(record_file, geom_filename, year):
 					"Month":filtered.Month,
 					"Day":filtered.Day})
 
-				tosave[country].append(tmp)
-
-	for country in tosave.keys():
-		if tosave[country] != []:
-			print("Now saving: ", country)
+				tosave.append(tmp)
+		return pd.concat(tosave) if tosave != [] else pd.DataFrame(columns=NEIGHBOURS_COLUMNS)
 
-			# saving the filtered dataset
-			tmp = pd.concat(tosave[country])
-			current = tmp.groupby(["Year","nISO"])[["AvgTone","GoldsteinScale"]].mean().reset_index()
-			current["ISO"] = country
-			tostore.append(current)
-		
-	tostore_df = pd.concat(tostore)
-	tostore_df.to_parquet(f"./data/neighbours_laginfo_{year}.parquet")
+	def collapse(partitions):
+		tostore = []
+		_, neighbours = load_boundaries()
+		tosave = pd.concat([tmp for tmp in partitions if tmp.shape[0] > 0])
+		for country in neighbours:
+			tmp = tosave[tosave.ISO==country]
+			if tmp.shape[0] > 0:
+				print("Now saving: ", country)
+				current = tmp.groupby(["Year","nISO"])[["AvgTone","GoldsteinScale"]].mean().reset_index()
+				current["ISO"] = country
+				tostore.append(current)
+		return pd.concat(tostore)
+
+	# each day of records belongs to a single year
+	memoize(CACHE, f"./data/neighbours_laginfo_{year}.parquet",
+		lambda: iter_partitions(record_file, keep=lambda day: day[:4]==year, batch_size=BATCH_SIZE),
+		compute, collapse, "extract_relationships_foreach_neighbours", year, hash_file(geom_filename), version)
+	t1 = time.time()
+	print("Elapsed (sec):", round(t1-t0, 3))
@@ -0,0 +1,310 @@
+#------------------------------------------------------------------------------
+# Content-addressed cache for derived artifacts: every output is keyed on the
+# hash of its input partitions, boundary file, parameters and code version
+#------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+"""
+example usage
+if __name__ == "__main__":
+
+	cache = ArtifactCache("./data/cache")
+	memoize(cache, "./data/days.parquet",
+		lambda: iter_partitions("./data/records_2020_2023.parquet"),
+		lambda df: pd.DataFrame({"count":[df.shape[0]]}),
+		lambda results: pd.concat(results), "count")
+"""
+
+CACHE_DIR = "./data/cache"
+CACHE_MAX_BYTES = 5*10**9        # total size of the stored artifacts
+CACHE_MAX_AGE = 30*24*60*60      # seconds since an artifact has been last read
+
+
+def hash_file(filename):
+	"""
+	Return the sha256 digest of a file content.
+	Shapefiles are spread over several sibling files (.shp, .shx, .dbf, .prj):
+	all the files sharing the same stem are hashed together. If a directory is
+	given, every file in it is considered.
+	"""
+	if os.path.isdir(filename):
+		filenames = [os.path.join(filename, name) for name in os.listdir(filename)]
+	else:
+		folder = os.path.dirname(filename) or "."
+		stem = os.path.splitext(os.path.basename(filename))[0]
+		filenames = [os.path.join(folder, name) for name in os.listdir(folder)
+			if os.path.splitext(name)[0] == stem]
+
+	h = hashlib.sha256()
+	for name in sorted(filenames):
+		if not os.path.isfile(name):
+			continue
+		h.update(os.path.basename(name).encode())
+		with open(name, "rb") as f:
+			for chunk in iter(lambda: f.read(2**20), b""):
+				h.update(chunk)
+	return h.hexdigest()
+
+
+def iter_partitions(record_file, column="DATEADDED", width=8, keep=None, batch_size=4*10**5):
+	"""
+	Yield (label, DataFrame) for each run of consecutive records sharing the
+	first width characters of column (the day, for DATEADDED), reading
+	batch_size records at a time.
+	Partitions follow the content of the file rather than fixed-size windows:
+	inserting, removing or reordering records only changes the partitions
+	they belong to.
+	Args:
+		keep: function on the label, skip the partitions for which it is False
+	"""
+	parquet_file = pq.ParquetFile(record_file)
+	label, buffer = None, []
+	for batch_partition in parquet_file.iter_batches(batch_size = batch_size):
+		batch = batch_partition.to_pandas()
+		if batch.shape[0] == 0:
+			continue
+		values = batch[column].astype(str).str[:width].to_numpy()
+		bounds = [0] + (np.flatnonzero(values[1:] != values[:-1]) + 1).tolist() + [len(values)]
+		for lo, hi in zip(bounds[:-1], bounds[1:]):
+			if values[lo] != label:
+				if buffer != []:
+					yield label, pd.concat(buffer)
+				label, buffer = values[lo], []
+			if keep is None or keep(label):
+				buffer.append(batch.iloc[lo:hi])
+	if buffer != []:
+		yield label, pd.concat(buffer)
+
+
+def hash_partition(df):
+	"""
+	Return the sha256 digest of a DataFrame (column names, types and content).
+	Rows are hashed one by one and sorted, so the digest does not depend on
+	their order (e.g. on an unstable sort of records sharing the timestamp).
+	"""
+	h = hashlib.sha256(json.dumps([[str(col), str(dtype)]
+		for col, dtype in df.dtypes.items()]).encode())
+	h.update(np.sort(pd.util.hash_pandas_object(df, index=False).to_numpy()).tobytes())
+	return h.hexdigest()
+
+
+def code_version(*funcs):
+	"""
+	Return the sha256 digest of the source of the given functions: a pipeline
+	function should list itself and the helpers its computation calls, so that
+	editing unrelated code does not invalidate its artifacts.
+	"""
+	h = hashlib.sha256()
+	for func in funcs:
+		h.update(inspect.getsource(func).encode())
+	return h.hexdigest()
+
+
+class ArtifactCache():
+	"""
+	Store DataFrames as parquet files named after their key, alongside a json
+	file holding their metadata (creation, last access, size, parameters).
+
+ 	Example Usage:
+	>>> cache = ArtifactCache("./data/cache", max_bytes = 10**9)
+	>>> key = cache.key("filter_by_year", "2021")
+	>>> cache.put(key, df, year = "2021")
+	>>> cache.get(key)
+	"""
+	def __init__(self, cache_dir:str = CACHE_DIR,
+		max_bytes:int = CACHE_MAX_BYTES,
+		max_age:float = CACHE_MAX_AGE):
+
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+
+	def _path(self, key, ext):
+		return os.path.join(self.cache_dir, f"{key}.{ext}")
+
+	def _write_metadata(self, key, metadata):
+		with open(self._path(key, "json"), "w") as f:
+			json.dump(metadata, f, default=str)
+
+	def key(self, *parts):
+		"""
+		Return the digest identifying an artifact given all of its inputs
+		"""
+		return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+	def metadata(self, key):
+		"""
+		Return the metadata of a stored artifact, None if not available
+		"""
+		try:
+			with open(self._path(key, "json"), "r") as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def touch(self, key):
+		"""
+		Mark a stored artifact as accessed, return whether it is available
+		"""
+		metadata = self.metadata(key)
+		if metadata is None or not os.path.exists(self._path(key, "parquet")):
+			return False
+		metadata["last_access"] = time.time()
+		self._write_metadata(key, metadata)
+		return True
+
+	def get(self, key):
+		"""
+		Return the stored DataFrame, None on cache miss
+		"""
+		if not self.touch(key):
+			return None
+		return pd.read_parquet(self._path(key, "parquet"))
+
+	def put(self, key, df, **metadata):
+		"""
+		Store a DataFrame together with its metadata
+		"""
+		os.makedirs(self.cache_dir, exist_ok=True)
+		tmp = self._path(key, "parquet.tmp")
+		df.to_parquet(tmp)
+		os.replace(tmp, self._path(key, "parquet"))
+
+		now = time.time()
+		metadata.update({
+			"key":key,
+			"created":now,
+			"last_access":now,
+			"rows":df.shape[0],
+			"size":os.path.getsize(self._path(key, "parquet"))})
+		self._write_metadata(key, metadata)
+
+	def remove(self, key):
+		for ext in ["parquet", "json"]:
+			if os.path.exists(self._path(key, ext)):
+				os.remove(self._path(key, ext))
+
+	def _keys(self):
+		if not os.path.isdir(self.cache_dir):
+			return []
+		return sorted({name.rsplit(".", 1)[0] for name in os.listdir(self.cache_dir)
+			if name.endswith(".json") or name.endswith(".parquet")})
+
+	def _is_valid(self, key, metadata):
+		return metadata is not None and os.path.exists(self._path(key, "parquet")) and \
+			all(field in metadata for field in ["key", "last_access", "size"])
+
+	def entries(self):
+		"""
+		Return the metadata of every stored artifact
+		"""
+		entries = [(key, self.metadata(key)) for key in self._keys()]
+		return [metadata for key, metadata in entries if self._is_valid(key, metadata)]
+
+	def evict(self):
+		"""
+		Remove the artifacts not accessed for more than max_age, then the least
+		recently used ones until the total size fits max_bytes. Incomplete
+		entries (missing parquet or metadata) are removed as well.
+		Return the list of removed keys.
+		"""
+		now = time.time()
+		removed = []
+		kept = []
+		for key in self._keys():
+			metadata = self.metadata(key)
+			if not self._is_valid(key, metadata) or now - metadata["last_access"] > self.max_age:
+				self.remove(key)
+				removed.append(key)
+			else:
+				kept.append(metadata)
+
+		kept.sort(key=lambda metadata: metadata["last_access"])
+		total = sum(metadata["size"] for metadata in kept)
+		while kept and total > self.max_bytes:
+			metadata = kept.pop(0)
+			self.remove(metadata["key"])
+			removed.append(metadata["key"])
+			total -= metadata["size"]
+		return removed
+
+
+def partition_keys(cache, partitions, *params):
+	"""
+	Return the key of each partition, hashing its content together with
+	params (parameters, boundary file hash, code version).
+	"""
+	return [cache.key(hash_partition(partition), *params) for _, partition in partitions]
+
+
+def cached_partitions(cache, partitions, compute, keys, store=True):
+	"""
+	Apply compute to each partition, reusing the stored result of the
+	partitions whose key (see partition_keys) is already in the cache.
+	Args:
+		cache: (ArtifactCache)
+		partitions: iterable of (label, DataFrame), see iter_partitions
+		compute: function mapping a partition DataFrame into a DataFrame
+		keys: key of each partition, in the same order
+		store: whether to store the results in the cache
+	Return the list of computed DataFrames
+	"""
+	toreturn = []
+	hits = 0
+	for (label, partition), key in zip(partitions, keys):
+		df = cache.get(key) if store else None
+		if df is None:
+			df = compute(partition)
+			if store:
+				cache.put(key, df, label=label)
+		else:
+			hits += 1
+		toreturn.append(df)
+	print(f"Partitions reused from cache: {hits}/{len(toreturn)}")
+	return toreturn
+
+
+def memoize(cache, output_file, partitions, compute, collapse, *params, store=True):
+	"""
+	Store into output_file the collapse of the per-partition results of compute.
+	Partitions are hashed first: if the output key recorded in
+	'{output_file}.json' still matches, nothing is loaded nor computed.
+	Otherwise the partitions are read again and only the ones missing from the
+	cache are computed.
+	Args:
+		partitions: function returning an iterable of (label, DataFrame), see
+			iter_partitions (it is called twice on cache miss)
+		compute: function mapping a partition DataFrame into a DataFrame
+		collapse: function mapping the list of computed DataFrames into the output
+		params: anything else the results depend on
+		store: whether to store the per-partition results in the cache. Leave it
+			to False when they are as large as the records and cheap to compute
+			(e.g. plain filters): the output file already holds them.
+	"""
+	keys = partition_keys(cache, partitions(), *params)
+	key = cache.key(keys)
+	try:
+		with open(f"{output_file}.json", "r") as f:
+			metadata = json.load(f)
+	except (OSError, ValueError):
+		metadata = dict()
+
+	if metadata.get("key") == key and os.path.exists(output_file):
+		print(f"Up to date: {output_file}")
+		for partition_key in keys if store else []:
+			cache.touch(partition_key)
+	else:
+		df = collapse(cached_partitions(cache, partitions(), compute, keys, store))
+		df.to_parquet(output_file)
+		with open(f"{output_file}.json", "w") as f:
+			json.dump({"key":key, "created":time.time(), "rows":df.shape[0], "params":params},
+				f, default=str)
+	cache.evict()
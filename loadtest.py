@@ -0,0 +1,83 @@
+# Load test of the local query endpoint (see query.py): report p50/p99 latency
+
+import sys
+import time
+import glob
+import random
+import asyncio
+import pandas as pd
+from query import DATA_DIR, HOST, PORT
+
+
+def build_targets(n_requests, distinct, data_dir=DATA_DIR):
+	"""
+	Return n_requests query urls drawn from a pool of distinct random queries
+	spread over countries, CAMEO codes, date ranges and endpoints (dashboards
+	repeat the same queries: the pool size drives the hot cache hit rate)
+	"""
+	isos = pd.read_csv(f"{data_dir}/event_predictors.csv", usecols=["ISO"]).ISO.unique().tolist()
+	cameos = [filename.split("timeseries_cameo")[-1][:-len(".parquet")]
+		for filename in glob.glob(f"{data_dir}/timeseries_cameo*.parquet")]
+	years = ["2020", "2021", "2022", "2023"]
+
+	targets = []
+	for _ in range(distinct):
+		iso, cameo = random.choice(isos), random.choice(cameos)
+		start, end = sorted(random.sample(years, 2))
+		targets.append(random.choice([
+			f"/timeseries?iso={iso}&cameo={cameo}&start={start}0101&end={end}1231",
+			f"/predictors?iso={iso}&cameo={cameo}&start={start}&end={end}",
+			f"/neighbours?iso={iso}&start={start}&end={end}"]))
+	return [random.choice(targets) for _ in range(n_requests)]
+
+
+async def worker(targets, latencies, errors, host, port):
+	"""
+	Issue the given requests one after the other over a keep-alive connection
+	"""
+	reader, writer = await asyncio.open_connection(host, port)
+	for target in targets:
+		t0 = time.perf_counter()
+		writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+		await writer.drain()
+		status = (await reader.readline()).decode()
+		length = 0
+		while True:
+			line = await reader.readline()
+			if line in [b"\r\n", b""]:
+				break
+			name, _, value = line.decode().partition(":")
+			if name.lower() == "content-length":
+				length = int(value)
+		await reader.readexactly(length)
+		if " 200 " in status:
+			latencies.append(time.perf_counter() - t0)
+		else:
+			errors.append(target)
+	writer.close()
+
+
+async def run(n_requests, concurrency, distinct, host=HOST, port=PORT):
+	targets = build_targets(n_requests, distinct)
+	latencies, errors = [], []
+	t0 = time.perf_counter()
+	await asyncio.gather(*[worker(targets[i::concurrency], latencies, errors, host, port)
+		for i in range(concurrency)])
+	t1 = time.perf_counter()
+
+	latencies.sort()
+	percentile = lambda q: latencies[min(len(latencies)-1, int(q*len(latencies)))]*1000
+	print(f"Requests: {len(latencies)+len(errors)} (errors: {len(errors)}) ; concurrency: {concurrency} ; distinct queries: {distinct}")
+	if latencies == []:
+		print("No successful response: latency not available")
+		return
+	print(f"Throughput: {round(len(latencies)/(t1-t0), 1)} req/sec")
+	print(f"Latency p50: {round(percentile(0.50), 3)} ms ; p99: {round(percentile(0.99), 3)} ms (successful responses only)")
+
+
+if __name__ == "__main__":
+	if len(sys.argv) not in [1, 4]:
+		print("Example usage:\npython loadtest.py 10000 32 500")
+		raise Exception
+	n_requests, concurrency, distinct = [int(arg) for arg in sys.argv[1:]] if len(sys.argv) == 4 else (10000, 32, 500)
+	asyncio.run(run(n_requests, concurrency, distinct))
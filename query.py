@@ -0,0 +1,249 @@
+#------------------------------------------------------------------------------
+# Read-only query API serving country timeseries, event predictors and
+# neighbours information, both as Python API and as local HTTP endpoint
+#------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import glob
+import asyncio
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd
+
+"""
+example usage
+if __name__ == "__main__":
+
+	qe = QueryEngine("./data")
+	qe.timeseries("AGO", start="20200101", end="20201231", cameo=14)
+	qe.predictors("AGO", start="2020", end="2022", cameo=14)
+	qe.neighbours("AGO", start="2021", end="2021")
+
+or, from a shell, serve the same queries on localhost:
+	python query.py 8000
+	curl "http://127.0.0.1:8000/timeseries?iso=AGO&cameo=14&start=20200101&end=20200131"
+"""
+
+DATA_DIR = "./data"
+HOST = "127.0.0.1"
+PORT = 8000
+HOT_SLICES = 1024
+
+TIMESERIES_COLUMNS = ["NAME_0", "Date", "count"]
+NEIGHBOURS_COLUMNS = ["ISO", "nISO", "Year", "AvgTone", "GoldsteinScale"]
+
+# countries of the boundaries shapefile missing from event_predictors.csv
+ISO_CODES = {
+	"Cape Verde":"CPV",
+	"Comoros":"COM",
+	"French Southern Territories":"ATF",
+	"Madagascar":"MDG",
+	"Mauritius":"MUS",
+	"Mayotte":"MYT",
+	"Reunion":"REU",
+	"Sao Tome and Principe":"STP",
+	"Seychelles":"SYC",
+	"Western Sahara":"ESH"}
+
+
+class QueryEngine():
+	"""
+	Preload the column-pruned datasets, indexed by ISO and sorted by date,
+	and serve slices of them. The most recently requested slices are kept in
+	an LRU cache of HOT_SLICES entries.
+
+	Dates are given as "YYYYMMDD", "YYYYMM" or "YYYY" strings: shorter bounds
+	cover the whole month/year, and yearly datasets only consider the first
+	4 characters of start/end.
+
+ 	Example Usage:
+	>>> qe = QueryEngine("./data")
+	>>> qe.timeseries("NGA", start="20220101", end="20220331", cameo=19)
+	"""
+	def __init__(self, data_dir:str = DATA_DIR, hot_slices:int = HOT_SLICES):
+
+		predictors = pd.read_csv(f"{data_dir}/event_predictors.csv").drop("Unnamed: 0", axis=1)
+		predictors["Year"] = predictors.Year.astype(str)
+		names = {**ISO_CODES, **dict(zip(predictors.NAME_0, predictors.ISO))}
+
+		self.cameos = []
+		self.timeseries_data = dict()
+		for filename in glob.glob(f"{data_dir}/timeseries_cameo*.parquet"):
+			cameo = int(os.path.basename(filename)[len("timeseries_cameo"):-len(".parquet")])
+			df = pd.read_parquet(filename, columns=TIMESERIES_COLUMNS)
+			df["ISO"] = df.NAME_0.map(names)
+			unmapped = df.NAME_0[df.ISO.isna()].unique().tolist()
+			if unmapped != []:
+				print(f"*** Warning: no ISO code for {unmapped} in {filename}: rows dropped")
+				df = df[df.ISO.notna()]
+			for iso, current in df.groupby("ISO"):
+				self.timeseries_data[(cameo, iso)] = current.sort_values("Date").reset_index(drop=True)
+			self.cameos.append(cameo)
+		self.cameos.sort()
+
+		self.predictors_data = {iso: current.sort_values("Year").reset_index(drop=True)
+			for iso, current in predictors.groupby("ISO")}
+
+		# the pipeline writes one file per year next to the multi-year one:
+		# the most recently written rows win
+		self.neighbours_data = dict()
+		filenames = sorted(glob.glob(f"{data_dir}/neighbours_laginfo_*.parquet"), key=os.path.getmtime)
+		if filenames != []:
+			neighbours = pd.concat([pd.read_parquet(filename, columns=NEIGHBOURS_COLUMNS)
+				for filename in filenames])
+			neighbours["Year"] = neighbours.Year.astype(str)
+			neighbours = neighbours.drop_duplicates(["ISO", "nISO", "Year"], keep="last")
+			self.neighbours_data = {iso: current.sort_values("Year").reset_index(drop=True)
+				for iso, current in neighbours.groupby("ISO")}
+
+		self._slice = lru_cache(maxsize=hot_slices)(self._compute_slice)
+		self._json = lru_cache(maxsize=hot_slices)(
+			lambda *args: self._slice(*args).to_json(orient="records"))
+
+	def _compute_slice(self, dataset, iso, start, end, cameo):
+		"""
+		Return the rows of a dataset for the given iso whose date (column "Date"
+		or "Year") falls within [start, end].
+		"""
+		if dataset == "timeseries":
+			if cameo not in self.cameos:
+				raise ValueError(f"Not a valid CAMEO Root Code: {cameo}. Available: {self.cameos}")
+			df, column = self.timeseries_data.get((cameo, iso)), "Date"
+		elif dataset == "predictors":
+			df, column = self.predictors_data.get(iso), "Year"
+		else:
+			df, column = self.neighbours_data.get(iso), "Year"
+
+		if df is None:
+			raise KeyError(f"No {dataset} data for ISO: {iso}")
+
+		# "YYYY" or "YYYYMM" bounds on daily data cover the whole year/month
+		if column == "Date":
+			start = None if start is None else start[:8].ljust(8, "0")
+			end = None if end is None else end[:8].ljust(8, "9")
+		else:
+			start = None if start is None else start[:4]
+			end = None if end is None else end[:4]
+		lo = 0 if start is None else df[column].searchsorted(start, side="left")
+		hi = df.shape[0] if end is None else df[column].searchsorted(end, side="right")
+		df = df.iloc[lo:hi]
+
+		if dataset == "predictors" and cameo is not None:
+			if f"EventRoot{cameo}" not in df.columns:
+				raise ValueError(f"Not a valid CAMEO Root Code: {cameo}")
+			df = df[[col for col in df.columns
+				if not col.startswith("EventRoot") or col == f"EventRoot{cameo}"]]
+		return df
+
+	def _args(self, dataset, iso, start, end, cameo):
+		if dataset not in ["timeseries", "predictors", "neighbours"]:
+			raise ValueError(f"Not a valid dataset: {dataset}")
+		cameo = None if cameo is None or dataset == "neighbours" else int(cameo)
+		return dataset, iso, start, end, cameo
+
+	def timeseries(self, iso, start=None, end=None, cameo=None):
+		"""
+		Return the daily count of events of a given CAMEO Root Code for a country
+		"""
+		return self._slice(*self._args("timeseries", iso, start, end, cameo)).copy()
+
+	def predictors(self, iso, start=None, end=None, cameo=None):
+		"""
+		Return the yearly event predictors of a country, optionally retaining
+		only the counts of a given CAMEO Root Code
+		"""
+		return self._slice(*self._args("predictors", iso, start, end, cameo)).copy()
+
+	def neighbours(self, iso, start=None, end=None, cameo=None):
+		"""
+		Return the yearly average tone of the events located in the neighbouring
+		countries (cameo is accepted for uniformity but not considered)
+		"""
+		return self._slice(*self._args("neighbours", iso, start, end, cameo)).copy()
+
+	def query_json(self, dataset, iso, start=None, end=None, cameo=None):
+		"""
+		Return the same slices as JSON records, the serialized hot slices being
+		cached as well (used by the HTTP endpoint)
+		"""
+		return self._json(*self._args(dataset, iso, start, end, cameo))
+
+
+async def respond(engine, method, target):
+	"""
+	Return the (status, body) pair of a single GET request
+	"""
+	routes = ["/timeseries", "/predictors", "/neighbours"]
+
+	url = urlsplit(target)
+	if url.path not in routes:
+		return "404 Not Found", json.dumps({"error":f"Unknown endpoint: {url.path}"})
+	if method != "GET":
+		return "405 Method Not Allowed", json.dumps({"error":f"Method not allowed: {method}"})
+
+	params = {name: values[0] for name, values in parse_qs(url.query).items()}
+	try:
+		body = await asyncio.to_thread(engine.query_json, url.path[1:], **params)
+		return "200 OK", body
+	except KeyError as e:
+		return "404 Not Found", json.dumps({"error":str(e.args[0])})
+	except (TypeError, ValueError) as e:
+		return "400 Bad Request", json.dumps({"error":str(e)})
+
+
+async def handle(engine, reader, writer):
+	"""
+	Serve the requests of a single (keep-alive) connection
+	"""
+	try:
+		while True:
+			request_line = await reader.readline()
+			if not request_line:
+				break
+			headers = dict()
+			while True:
+				line = await reader.readline()
+				if line in [b"\r\n", b"\n", b""]:
+					break
+				name, _, value = line.decode("latin-1").partition(":")
+				headers[name.strip().lower()] = value.strip()
+
+			# drain the request body, if any, so that it is not read as the next
+			# request line; chunked bodies are not supported: close after replying
+			await reader.readexactly(int(headers.get("content-length", 0)))
+			keep_alive = headers.get("connection", "").lower() != "close" and \
+				"transfer-encoding" not in headers
+
+			method, target, _ = request_line.decode("latin-1").split(" ", 2)
+			status, body = await respond(engine, method, target)
+			body = body.encode()
+
+			allow = "Allow: GET\r\n" if status.startswith("405") else ""
+			writer.write((f"HTTP/1.1 {status}\r\n"
+				"Content-Type: application/json\r\n"
+				f"{allow}"
+				f"Content-Length: {len(body)}\r\n"
+				f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body)
+			await writer.drain()
+			if not keep_alive:
+				break
+	except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+		pass
+	finally:
+		writer.close()
+
+
+async def serve(engine, host=HOST, port=PORT):
+	server = await asyncio.start_server(
+		lambda reader, writer: handle(engine, reader, writer), host, port)
+	print(f"Serving on http://{host}:{port} (endpoints: /timeseries, /predictors, /neighbours)")
+	async with server:
+		await server.serve_forever()
+
+
+if __name__ == "__main__":
+	port = int(sys.argv[1]) if len(sys.argv) == 2 else PORT
+	engine = QueryEngine(DATA_DIR)
+	asyncio.run(serve(engine, HOST, port))